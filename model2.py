@@ -6,6 +6,7 @@ import PyPDF2
 import logging
 from datetime import datetime
 import json
+from retention import RetentionManager, env_number
 
 # Business prompt remains unchanged
 business_prompt = """
@@ -41,20 +42,27 @@ client = chromadb.Client()
 db = client.get_or_create_collection(name=DB_NAME)
 conversation_db = client.get_or_create_collection(name=CONVERSATION_DB)
 
+CONVERSATION_DIR = "conversations"
+
+retention = RetentionManager(
+    collection=conversation_db,
+    directory=CONVERSATION_DIR,
+    max_turns=env_number('CONVERSATION_MAX_TURNS', 50, int),
+    max_age_days=env_number('CONVERSATION_MAX_AGE_DAYS', 30),
+    budget_bytes=int(env_number('CONVERSATION_BUDGET_MB', 100) * 1024 * 1024),
+    max_user_bytes=int(env_number('CONVERSATION_MAX_USER_MB', 1) * 1024 * 1024)
+)
+
 class ConversationManager:
     def __init__(self, username):
         self.username = username
-        self.conversation_file = f"conversations/{username}_history.json"
-        os.makedirs("conversations", exist_ok=True)
+        self.conversation_file = retention.history_file(username)
 
     def load_conversation(self):
         try:
-            if os.path.exists(self.conversation_file):
-                with open(self.conversation_file, 'r') as f:
-                    history = json.load(f)
-                    logger.info(f"Loaded conversation history for user {self.username}")
-                    return history
-            return []
+            history = retention.load(self.username)
+            logger.info(f"Loaded conversation history for user {self.username}")
+            return history
         except Exception as e:
             logger.error(f"Error loading conversation: {str(e)}")
             return []
@@ -71,19 +79,8 @@ class ConversationManager:
                 if formatted_msg['query'] or formatted_msg['response']:
                     formatted_history.append(formatted_msg)
 
-            with open(self.conversation_file, 'w') as f:
-                json.dump(formatted_history, f)
-            
-            # Store in ChromaDB for vector search
-            for msg in formatted_history:
-                if msg['query'] and msg['response']:
-                    conversation_text = f"Q: {msg['query']}\nA: {msg['response']}"
-                    conversation_id = f"{self.username}_{msg['timestamp']}"
-                    conversation_db.add(
-                        documents=[conversation_text],
-                        ids=[conversation_id],
-                        metadatas={"username": self.username, "timestamp": msg['timestamp']}
-                    )
+            # Writes the file and the ChromaDB rows for vector search
+            retention.replace(self.username, formatted_history)
             
             logger.info(f"Saved conversation history for user {self.username}")
         except Exception as e:
@@ -91,26 +88,13 @@ class ConversationManager:
             raise
 
     def add_interaction(self, query, response):
-        history = self.load_conversation()
         interaction = {
             'timestamp': datetime.now().isoformat(),
             'query': query,
             'response': response
         }
-        history.append(interaction)
-        
-        # Save to file
-        with open(self.conversation_file, 'w') as f:
-            json.dump(history, f)
-
-        # Store in ChromaDB
-        conversation_text = f"Q: {query}\nA: {response}"
-        conversation_id = f"{self.username}_{interaction['timestamp']}"
-        conversation_db.add(
-            documents=[conversation_text],
-            ids=[conversation_id],
-            metadatas={"username": self.username, "timestamp": interaction['timestamp']}
-        )
+        # Save to file and ChromaDB
+        retention.append(self.username, [interaction])
 
     def get_relevant_history(self, current_query, n_results=3):
         try:
@@ -150,6 +134,10 @@ def get_conversation_history(username):
         logger.error(f"Error retrieving conversation history: {str(e)}")
         return jsonify({"error": "Failed to retrieve conversation history"}), 500
 
+@app.route("/retention/usage", methods=["GET"])
+def get_retention_usage():
+    return jsonify(retention.usage())
+
 @app.route("/store_conversation", methods=["POST"])
 def store_conversation():
     try:
@@ -229,4 +217,5 @@ def process_query():
         return jsonify({"error": "An error occurred processing your query"}), 500
 
 if __name__ == "__main__":
+    retention.load_existing()
     app.run(host="0.0.0.0", port=3000)
\ No newline at end of file
@@ -0,0 +1,419 @@
+import os
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+HISTORY_SUFFIX = "_history.json"
+
+# Estimated cost of one row in the Conversations collection on top of its
+# document text: a 384-dim float32 embedding (1536 bytes) plus the HNSW index
+# entry, id and metadata, rounded up.
+COLLECTION_ROW_OVERHEAD = 2048
+
+# Number of per-user lock stripes, so the lock table stays bounded no matter
+# how many users have been seen.
+LOCK_STRIPES = 64
+
+
+def env_number(name, default, cast=float):
+    """Read a non-negative number from the environment, failing with a clear message."""
+    raw = os.getenv(name)
+    if raw is None:
+        return cast(default)
+    try:
+        value = cast(raw)
+    except ValueError:
+        raise ValueError(f"{name} must be a non-negative number, got {raw!r}") from None
+    if value < 0:
+        raise ValueError(f"{name} must be a non-negative number, got {raw!r}")
+    return value
+
+
+def document_text(msg):
+    return f"Q: {msg['query']}\nA: {msg['response']}"
+
+
+def is_indexed(msg):
+    """Only complete question/answer turns are stored in the collection."""
+    return bool(msg.get('query') and msg.get('response'))
+
+
+class RetentionManager:
+    """Bounds stored conversation data by turns, age and a global byte budget.
+
+    A user's footprint is the size of their JSON file on disk plus an estimate
+    of what their rows cost in the Conversations collection (document text and
+    COLLECTION_ROW_OVERHEAD per row). Users are kept in least-recently-active
+    order so the budget is enforced by evicting the oldest inactive users
+    first, and no single user may grow past max_user_bytes. A limit of 0
+    disables that limit.
+    """
+
+    def __init__(self, collection, directory, max_turns, max_age_days, budget_bytes,
+                 max_user_bytes, sweep_interval=60):
+        self.collection = collection
+        self.directory = directory
+        self.max_turns = max_turns
+        self.max_age = max_age_days * 86400
+        self.budget_bytes = budget_bytes
+        if budget_bytes and (not max_user_bytes or max_user_bytes > budget_bytes):
+            max_user_bytes = budget_bytes
+        self.max_user_bytes = max_user_bytes
+        self.sweep_interval = sweep_interval
+        self._users = OrderedDict()  # username -> (last_active, disk_bytes, rows, row_bytes)
+        self._slots = {}  # username -> {conversation_id: collection row id}
+        self._free_rows = []  # detached collection rows ready for reuse
+        self._next_row = 0
+        self._disk_bytes = 0
+        self._rows = 0
+        self._row_bytes = 0
+        self._last_sweep = 0.0
+        self._evicted = 0
+        self._lock = threading.Lock()
+        self._user_locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        os.makedirs(directory, exist_ok=True)
+
+    def history_file(self, username):
+        return os.path.join(self.directory, f"{username}{HISTORY_SUFFIX}")
+
+    def conversation_id(self, username, msg):
+        return f"{username}_{msg['timestamp']}"
+
+    def user_lock(self, username):
+        return self._user_locks[self._stripe(username)]
+
+    def _stripe(self, username):
+        return hash(username) % LOCK_STRIPES
+
+    def load(self, username):
+        path = self.history_file(username)
+        if not os.path.exists(path):
+            return []
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    @staticmethod
+    def _parse_timestamp(value):
+        try:
+            return datetime.fromisoformat(value).timestamp()
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def _entry_cost(msg):
+        # Serialized entry plus its list separator, and its collection row if any
+        cost = len(json.dumps(msg)) + 2
+        if is_indexed(msg):
+            cost += COLLECTION_ROW_OVERHEAD + len(document_text(msg))
+        return cost
+
+    @classmethod
+    def _truncate(cls, msg, excess):
+        """Shorten the text of an entry until it costs excess bytes less."""
+        msg = dict(msg)
+        while excess > 0 and (msg.get('query') or msg.get('response')):
+            field = 'response' if len(msg.get('response') or '') >= len(msg.get('query') or '') else 'query'
+            text = msg[field]
+            # Each character is counted in both the file and the document
+            cut = min(len(text), max(excess // 2, 1))
+            before = cls._entry_cost(msg)
+            msg[field] = text[:len(text) - cut]
+            excess -= before - cls._entry_cost(msg)
+        return msg
+
+    def trim(self, history, username=None):
+        """Return the part of history within the age, turn and per-user size limits.
+
+        Oldest turns are dropped first. The newest turn is never dropped for
+        size; if it alone is over max_user_bytes its text is truncated.
+        """
+        original = len(history)
+        if self.max_age:
+            cutoff = time.time() - self.max_age
+            kept = []
+            for msg in history:
+                ts = self._parse_timestamp(msg.get('timestamp'))
+                if ts is None or ts >= cutoff:
+                    kept.append(msg)
+            history = kept
+        expired = original - len(history)
+        if self.max_turns and len(history) > self.max_turns:
+            history = history[-self.max_turns:]
+        over_turns = original - expired - len(history)
+        truncated = False
+        if self.max_user_bytes and history:
+            costs = [self._entry_cost(msg) for msg in history]
+            total = sum(costs) + 2
+            start = 0
+            while start < len(history) - 1 and total > self.max_user_bytes:
+                total -= costs[start]
+                start += 1
+            history = history[start:]
+            if total > self.max_user_bytes:
+                history[-1] = self._truncate(history[-1], total - self.max_user_bytes)
+                truncated = True
+        over_size = original - expired - over_turns - len(history)
+        if expired or over_turns or over_size:
+            logger.info(
+                f"Dropped {expired + over_turns + over_size} turns for user {username} "
+                f"({expired} expired, {over_turns} over turn limit, {over_size} over size limit)"
+            )
+        if truncated:
+            logger.warning(f"Truncated newest turn for user {username} to fit {self.max_user_bytes} bytes")
+        return history
+
+    def append(self, username, entries):
+        """Add entries to a user's history, returning the retained history."""
+        with self.user_lock(username):
+            history, evict = self._commit(username, self.load(username) + entries)
+        self.evict(evict)
+        return history
+
+    def replace(self, username, history):
+        """Replace a user's history, returning the retained part of it."""
+        with self.user_lock(username):
+            history, evict = self._commit(username, history)
+        self.evict(evict)
+        return history
+
+    @staticmethod
+    def _write_file(path, data):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _rows_cost(rows):
+        return sum(COLLECTION_ROW_OVERHEAD + len(document_text(msg)) for msg in rows)
+
+    def _sync_rows(self, username, rows):
+        """Make the user's collection rows match rows; must hold the user's lock.
+
+        Rows are never deleted from the collection, because ChromaDB's HNSW
+        index keeps deleted entries in memory and grows with every insert.
+        Rows of dropped turns are detached (their metadata no longer matches
+        any user) and overwritten by later turns instead.
+        """
+        with self._lock:
+            held = self._slots.pop(username, {})
+        wanted = {self.conversation_id(username, msg): msg for msg in rows}
+        keep = {cid: held.pop(cid) for cid in wanted if cid in held}
+        missing = [cid for cid in wanted if cid not in keep]
+        spare = list(held.values())
+        row_ids, spare = spare[:len(missing)], spare[len(missing):]
+        with self._lock:
+            while len(row_ids) < len(missing) and self._free_rows:
+                row_ids.append(self._free_rows.pop())
+            while len(row_ids) < len(missing):
+                row_ids.append(f"row-{self._next_row}")
+                self._next_row += 1
+
+        assigned = {}
+        try:
+            if missing:
+                self.collection.upsert(
+                    documents=[document_text(wanted[cid]) for cid in missing],
+                    ids=row_ids,
+                    metadatas=[{"username": username, "timestamp": wanted[cid]['timestamp']} for cid in missing]
+                )
+                assigned = dict(zip(missing, row_ids))
+            if spare:
+                self._detach(spare)
+        finally:
+            with self._lock:
+                if not assigned:
+                    self._free_rows.extend(row_ids)
+                self._free_rows.extend(spare)
+                if keep or assigned:
+                    self._slots[username] = {**keep, **assigned}
+        return [wanted[cid] for cid in {**keep, **assigned}]
+
+    def _detach(self, row_ids):
+        self.collection.update(ids=row_ids, metadatas=[{"username": "", "timestamp": ""}] * len(row_ids))
+
+    def _discard(self, username):
+        """Drop a user with nothing left to keep; must hold the user's lock."""
+        self._sync_rows(username, [])
+        try:
+            os.remove(self.history_file(username))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"Error removing history for user {username}: {str(e)}")
+        with self._lock:
+            self._remove(username)
+
+    def _commit(self, username, history):
+        # Must hold the user's lock: file, collection and index are updated together
+        history = self.trim(history, username)
+        if not history:
+            # Nothing left to keep, so don't spend a file or an index slot on it
+            self._discard(username)
+            return history, []
+
+        data = json.dumps(history)
+        self._write_file(self.history_file(username), data)
+        indexed = [msg for msg in history if is_indexed(msg)]
+        try:
+            rows = self._sync_rows(username, indexed)
+        except Exception as e:
+            # The file is written; account for whatever rows the user still holds
+            logger.error(f"Error storing conversations for user {username}: {str(e)}")
+            with self._lock:
+                held = self._slots.get(username, {})
+                rows = [msg for msg in indexed if self.conversation_id(username, msg) in held]
+        evict = self._touch(username, time.time(), len(data), len(rows), self._rows_cost(rows))
+        return history, evict
+
+    def load_existing(self):
+        """Index histories already on disk, trimming them and sweeping expired users.
+
+        The collection does not survive a restart, so the retained turns are
+        written back to it here to keep it in line with the files.
+        """
+        entries = []
+        trimmed = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(HISTORY_SUFFIX):
+                continue
+            username = name[:-len(HISTORY_SUFFIX)]
+            path = os.path.join(self.directory, name)
+            with self.user_lock(username):
+                try:
+                    mtime = os.stat(path).st_mtime
+                    history = self.load(username)
+                except (OSError, ValueError) as e:
+                    logger.error(f"Skipping unreadable history {path}: {str(e)}")
+                    continue
+                kept = self.trim(history, username)
+                if not kept:
+                    trimmed += 1
+                    self._discard(username)
+                    continue
+                data = json.dumps(kept)
+                if kept != history:
+                    trimmed += 1
+                    self._write_file(path, data)
+                    os.utime(path, (mtime, mtime))
+                try:
+                    rows = self._sync_rows(username, [msg for msg in kept if is_indexed(msg)])
+                except Exception as e:
+                    logger.error(f"Error restoring conversations for user {username}: {str(e)}")
+                    rows = []
+                entries.append((mtime, username, len(data), len(rows), self._rows_cost(rows)))
+        entries.sort()
+        with self._lock:
+            for last_active, username, disk_bytes, rows, row_bytes in entries:
+                self._set(username, last_active, disk_bytes, rows, row_bytes)
+            evict = self._enforce(time.time(), force_sweep=True)
+        if trimmed:
+            logger.info(f"Trimmed {trimmed} conversation histories to the retention limits")
+        if evict:
+            logger.info(f"Startup sweep evicting {len(evict)} users: {', '.join(evict)}")
+        self.evict(evict)
+
+    def _touch(self, username, now, disk_bytes, rows, row_bytes):
+        """Record activity for a user and return whoever now falls outside the limits."""
+        with self._lock:
+            self._set(username, now, disk_bytes, rows, row_bytes)
+            return self._enforce(now, protect=username)
+
+    def evict(self, usernames):
+        """Remove users from disk and the collection unless they became active again."""
+        if not usernames:
+            return
+        locks = [self._user_locks[i] for i in sorted({self._stripe(u) for u in usernames})]
+        for lock in locks:
+            lock.acquire()
+        try:
+            with self._lock:
+                batch = [u for u in usernames if u not in self._users]
+                row_ids = [
+                    row_id for u in batch
+                    for row_id in self._slots.pop(u, {}).values()
+                ]
+            for username in batch:
+                try:
+                    os.remove(self.history_file(username))
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logger.error(f"Error removing history for user {username}: {str(e)}")
+            if row_ids:
+                try:
+                    self._detach(row_ids)
+                except Exception as e:
+                    logger.error(f"Error evicting conversations: {str(e)}")
+                with self._lock:
+                    self._free_rows.extend(row_ids)
+            if batch:
+                logger.info(f"Evicted conversation history for {len(batch)} users")
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def usage(self):
+        with self._lock:
+            return {
+                "users": len(self._users),
+                "disk_bytes": self._disk_bytes,
+                "collection_rows": self._rows,
+                "collection_free_rows": len(self._free_rows),
+                "collection_bytes_estimate": self._row_bytes,
+                "total_bytes": self._disk_bytes + self._row_bytes,
+                "budget_bytes": self.budget_bytes,
+                "max_user_bytes": self.max_user_bytes,
+                "max_turns": self.max_turns,
+                "max_age_days": self.max_age / 86400,
+                "evicted_users": self._evicted,
+            }
+
+    def _set(self, username, last_active, disk_bytes, rows, row_bytes):
+        self._remove(username)
+        self._users[username] = (last_active, disk_bytes, rows, row_bytes)
+        self._disk_bytes += disk_bytes
+        self._rows += rows
+        self._row_bytes += row_bytes
+
+    def _remove(self, username):
+        entry = self._users.pop(username, None)
+        if entry:
+            _, disk_bytes, rows, row_bytes = entry
+            self._disk_bytes -= disk_bytes
+            self._rows -= rows
+            self._row_bytes -= row_bytes
+
+    def _enforce(self, now, protect=None, force_sweep=False):
+        # Only updates the index; callers delete the data after releasing the lock
+        evict = []
+        if self.max_age and (force_sweep or now - self._last_sweep >= self.sweep_interval):
+            self._last_sweep = now
+            cutoff = now - self.max_age
+            # Ordered by activity, so expired users are all at the front
+            for username, (last_active, *_) in self._users.items():
+                if last_active >= cutoff:
+                    break
+                if username != protect:
+                    evict.append(username)
+            for username in evict:
+                self._remove(username)
+        if self.budget_bytes:
+            # Every user is capped at max_user_bytes <= budget_bytes, so this
+            # never needs to go past the protected user
+            while self._users and self._disk_bytes + self._row_bytes > self.budget_bytes:
+                username = next(iter(self._users))
+                if username == protect:
+                    if len(self._users) == 1:
+                        break
+                    self._users.move_to_end(username)
+                    continue
+                self._remove(username)
+                evict.append(username)
+        self._evicted += len(evict)
+        return evict
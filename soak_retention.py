@@ -0,0 +1,193 @@
+"""Soak test for conversation retention.
+
+Drives RetentionManager with a temporary conversations directory and checks
+that process RSS, traced Python memory, the number of history files and the
+collection row count stay flat once the budget is reached. It then simulates
+a restart (empty collection, histories still on disk) and checks that the
+reported collection rows match the collection.
+
+By default the collection is an in-memory stand-in, which is fast. With
+--chroma it is a real chromadb.EphemeralClient() collection, so the HNSW index
+and in-memory sqlite are exercised too. It uses a hash-based embedding so the
+run needs no model download.
+
+Usage: python soak_retention.py [--messages N] [--users N] [--chroma]
+"""
+import os
+import random
+import hashlib
+import logging
+import argparse
+import resource
+import tempfile
+import tracemalloc
+from datetime import datetime, timedelta
+
+from retention import RetentionManager
+
+CONVERSATION_DB = "Conversations"
+
+
+class MemoryCollection:
+    """Implements the subset of the ChromaDB collection API that retention uses."""
+
+    def __init__(self):
+        self.rows = {}
+
+    def upsert(self, documents, ids, metadatas):
+        for row_id, document, metadata in zip(ids, documents, metadatas):
+            self.rows[row_id] = (document, metadata)
+
+    def update(self, ids, metadatas):
+        for row_id, metadata in zip(ids, metadatas):
+            self.rows[row_id] = (self.rows[row_id][0], metadata)
+
+    def count(self):
+        return len(self.rows)
+
+
+def chroma_collection_factory():
+    import numpy as np
+    import chromadb
+    from chromadb.config import Settings
+
+    class HashEmbedding(chromadb.EmbeddingFunction):
+        """384-dim embedding, the same size as the default model's."""
+
+        def __init__(self):
+            pass
+
+        def __call__(self, input):
+            return [
+                np.frombuffer(hashlib.shake_256(text.encode()).digest(384 * 4), dtype=np.uint32)
+                .astype(np.float32) / 2 ** 32
+                for text in input
+            ]
+
+        @staticmethod
+        def name():
+            return "soak-hash"
+
+        def get_config(self):
+            return {}
+
+        @staticmethod
+        def build_from_config(config):
+            return HashEmbedding()
+
+    client = chromadb.EphemeralClient(settings=Settings(anonymized_telemetry=False))
+
+    def new_collection():
+        # A fresh collection is what model2.py sees after a restart
+        try:
+            client.delete_collection(CONVERSATION_DB)
+        except Exception:
+            pass
+        return client.get_or_create_collection(name=CONVERSATION_DB, embedding_function=HashEmbedding())
+
+    return new_collection
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Peak rather than current RSS, still enough to show growth
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def new_retention(collection, directory):
+    return RetentionManager(
+        collection=collection,
+        directory=directory,
+        max_turns=20,
+        max_age_days=30,
+        budget_bytes=8 * 1024 * 1024,
+        max_user_bytes=64 * 1024
+    )
+
+
+def interaction(when, i):
+    return {
+        'timestamp': when.isoformat(),
+        'query': f"question {i} " * random.randint(1, 10),
+        'response': f"answer {i} " * random.randint(5, 40)
+    }
+
+
+def run(directory, new_collection, messages, users, checkpoints):
+    conversation_db = new_collection()
+    retention = new_retention(conversation_db, directory)
+
+    start = datetime.now()
+    step = max(messages // checkpoints, 1)
+    samples = []
+    tracemalloc.start()
+    for i in range(1, messages + 1):
+        username = f"user{random.randrange(users)}"
+        retention.append(username, [interaction(start + timedelta(microseconds=i), i)])
+        if i % step == 0:
+            sample = (
+                rss_bytes(),
+                tracemalloc.get_traced_memory()[0],
+                len(os.listdir(directory)),
+                conversation_db.count(),
+            )
+            samples.append(sample)
+            usage = retention.usage()
+            print(f"{i:>10} messages  rss={sample[0]:>11}  traced={sample[1]:>10}  files={sample[2]:>6}  "
+                  f"rows={sample[3]:>6}  total_bytes={usage['total_bytes']}", flush=True)
+            assert usage['total_bytes'] <= retention.budget_bytes
+            # Freed rows stay in the collection, detached, until they are reused
+            assert usage['collection_rows'] + usage['collection_free_rows'] == conversation_db.count()
+    tracemalloc.stop()
+    return samples
+
+
+def check_restart(directory, new_collection):
+    conversation_db = new_collection()
+    retention = new_retention(conversation_db, directory)
+    retention.load_existing()
+    usage = retention.usage()
+    assert usage['collection_rows'] == conversation_db.count(), \
+        f"after restart: {usage['collection_rows']} rows reported, {conversation_db.count()} stored"
+    assert usage['collection_free_rows'] == 0
+    assert usage['users'] == len(os.listdir(directory))
+
+    username = next(iter(os.listdir(directory))).split("_history.json")[0]
+    retention.append(username, [interaction(datetime.now(), 0)])
+    usage = retention.usage()
+    stored = usage['collection_rows'] + usage['collection_free_rows']
+    assert stored == conversation_db.count(), \
+        f"after restart and append: {stored} rows reported, {conversation_db.count()} stored"
+    print(f"restart: users={usage['users']}  rows={usage['collection_rows']}  matches collection")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=2_000_000)
+    parser.add_argument("--users", type=int, default=50_000)
+    parser.add_argument("--checkpoints", type=int, default=20)
+    parser.add_argument("--chroma", action="store_true", help="use a real chromadb.EphemeralClient() collection")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    random.seed(0)
+    new_collection = chroma_collection_factory() if args.chroma else MemoryCollection
+    with tempfile.TemporaryDirectory(prefix="soak_conversations_") as directory:
+        samples = run(directory, new_collection, args.messages, args.users, args.checkpoints)
+        check_restart(directory, new_collection)
+
+    # The first checkpoints are warm-up; afterwards everything must stay flat
+    baseline = samples[len(samples) // 4]
+    for sample in samples[len(samples) // 4 + 1:]:
+        assert sample[0] <= baseline[0] * 1.1, f"RSS grew: {baseline[0]} -> {sample[0]}"
+        assert sample[1] <= baseline[1] * 1.1, f"traced memory grew: {baseline[1]} -> {sample[1]}"
+        assert sample[2] <= baseline[2] * 1.1, f"file count grew: {baseline[2]} -> {sample[2]}"
+        assert sample[3] <= baseline[3] * 1.1, f"collection grew: {baseline[3]} -> {sample[3]}"
+    print("OK: RSS, traced memory, files and collection rows stayed flat")
+
+
+if __name__ == "__main__":
+    main()